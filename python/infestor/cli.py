@@ -58,6 +58,7 @@ def handle_config_token(args: argparse.Namespace) -> None:
             args.repository,
             config_object.reporter_filepath,
             force=True,
+            configuration=config_object,
         )
 
     print(config_object)
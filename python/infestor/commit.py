@@ -1,11 +1,11 @@
 import os
-from typing import List
+from typing import List, Union
 
 import pygit2
 
 
 def commit_files(
-    repository: str,
+    repository: Union[str, pygit2.Repository],
     ref: str,
     filepaths: List[str],
     message: str,
@@ -15,10 +15,16 @@ def commit_files(
     """
     Adds the given files to the repo index and makes a commit.
 
+    repository can either be the path to the repository or a pygit2.Repository which the
+    caller has already opened, in which case it is not opened again.
+
     Pygit2 commit recipe: https://gist.github.com/lig/dc1ede7e09488a62116fe90aa31617d9
     """
     signature = pygit2.Signature(author, email)
-    repo = pygit2.Repository(path=repository)
+    if isinstance(repository, pygit2.Repository):
+        repo = repository
+    else:
+        repo = pygit2.Repository(path=repository)
     for filepath in filepaths:
         repo.index.add(filepath)
     tree = repo.index.write_tree()
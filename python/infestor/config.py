@@ -1,7 +1,8 @@
 """
 These are the tools infestor uses to set up a code base for automatic Humbug instrumentation.
 """
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass
+import functools
 import json
 import os
 from typing import Any, cast, Dict, List, Optional, Tuple
@@ -33,6 +34,13 @@ class InfestorConfiguration:
     reporter_filepath: Optional[str] = None
     reporter_object_name: str = DEFAULT_REPORTER_OBJECT_NAME
 
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Returns the configuration as a (JSON serializable) dictionary. All fields are
+        scalars, so unlike dataclasses.asdict, this does not need to deep copy them.
+        """
+        return self.__dict__.copy()
+
 
 class ConfigurationError(Exception):
     """
@@ -121,8 +129,33 @@ def load_config(
     return cast(InfestorConfiguration, configuration)
 
 
+@functools.lru_cache(maxsize=16)
+def _load_config_cached(
+    config_file: str, mtime_ns: int, size: int, inode: int
+) -> InfestorConfiguration:
+    return load_config(config_file)
+
+
+def get_config(repository: str) -> InfestorConfiguration:
+    """
+    Loads the infestor configuration for the given repository. The configuration is only read from
+    disk again if the config file has changed since it was last loaded.
+
+    The returned configuration is shared between callers and must not be modified. Use load_config
+    to get a configuration object that you intend to change and save.
+    """
+    config_file = default_config_file(repository)
+    try:
+        stat_result = os.stat(config_file)
+    except OSError:
+        raise ConfigurationError(f"Could not read configuration: {config_file}")
+    return _load_config_cached(
+        config_file, stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino
+    )
+
+
 def save_config(config_file: str, configuration: InfestorConfiguration) -> None:
-    result_configuration = asdict(configuration)
+    result_configuration = configuration.to_dict()
     with atomic_write(config_file, overwrite=True) as ofp:
         json.dump(result_configuration, ofp)
 
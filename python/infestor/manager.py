@@ -1,17 +1,20 @@
-from typing import Tuple, List, Optional
+import functools
+import hashlib
+import importlib.metadata
+import logging
 import os
 from pathlib import Path
+import pickle
+from typing import Tuple, List, Optional
 
+from atomicwrites import atomic_write
 import libcst as cst
 
+from . import models
 from . import visitors
 from . import transformers
 from .errors import *
-from .config import (
-    default_config_file,
-    load_config,
-    InfestorConfiguration,
-)
+from .config import get_config, InfestorConfiguration
 
 # TODO(zomglings): Use an Enum here.
 CALL_TYPE_SYSTEM_REPORT = "system_report"
@@ -20,6 +23,68 @@ CALL_TYPE_SETUP_EXCEPTHOOK = "setup_excepthook"
 DECORATOR_TYPE_RECORD_CALL = "record_call"
 DECORATOR_TYPE_RECORD_ERRORS = "record_errors"
 
+# Set this environment variable to a directory to cache parsed syntax trees in it.
+CACHE_DIR_ENV_VAR = "INFESTOR_CACHE_DIR"
+
+
+@functools.lru_cache(maxsize=None)
+def relative_reporter_import_path(submodule_dir: str, reporter_filepath: str) -> str:
+    """
+    Returns the relative path from which modules in the directory submodule_dir should
+    import the reporter defined at reporter_filepath.
+
+    All modules in a directory import the reporter from the same path, so results are
+    cached per directory rather than per module.
+    """
+    # TODO(zomglings): Check that common_ancestor is a subpath of repository. Raise error if it is not.
+    common_ancestor = os.path.commonpath([submodule_dir, reporter_filepath])
+    common_ancestor_to_submodule_dir = os.path.relpath(
+        submodule_dir, start=common_ancestor
+    )
+    common_ancestor_to_reporter_module, _ = os.path.splitext(
+        os.path.relpath(reporter_filepath, start=common_ancestor)
+    )
+    reporter_module = common_ancestor_to_reporter_module.replace(os.sep, ".")
+
+    # One dot per directory between the common ancestor and the submodule.
+    import_dots = ""
+    if common_ancestor_to_submodule_dir != os.curdir:
+        import_dots = "." * (common_ancestor_to_submodule_dir.count(os.sep) + 1)
+
+    return f"{import_dots}.{reporter_module}"
+
+
+@functools.lru_cache(maxsize=None)
+def absolute_reporter_import_path(repository: str, reporter_filepath: str) -> str:
+    """
+    Returns the absolute path from which any module in the given repository should import
+    the reporter defined at reporter_filepath.
+    """
+    repository_to_reporter_module, _ = os.path.splitext(
+        os.path.relpath(reporter_filepath, start=repository)
+    )
+    reporter_module = repository_to_reporter_module.replace(os.sep, ".")
+    repository_name = os.path.basename(repository)
+
+    return f"{repository_name}.{reporter_module}"
+
+
+def reporter_import_path(
+    repository: str,
+    submodule_path: str,
+    reporter_filepath: str,
+    relative_imports: bool,
+) -> str:
+    """
+    Returns the path from which the submodule at the given submodule_path should import the
+    reporter defined at reporter_filepath.
+    """
+    if relative_imports:
+        return relative_reporter_import_path(
+            os.path.dirname(submodule_path), reporter_filepath
+        )
+    return absolute_reporter_import_path(repository, reporter_filepath)
+
 
 def get_reporter_import_information(
     repository: str,
@@ -38,103 +103,129 @@ def get_reporter_import_information(
        reporter module for the given repository.
     """
     if configuration is None:
-        config_file = default_config_file(repository)
-        configuration = load_config(config_file)
-        if configuration is None:
-            raise GenerateReporterError(
-                f"Could not load configuration from file ({config_file})"
-            )
+        configuration = get_config(repository)
 
     if configuration.reporter_filepath is None:
         raise GenerateReporterError(f"No reporter defined for project.")
 
-    # We will set this in the next if-else statement.
-    import_path = ""
+    import_path = reporter_import_path(
+        repository,
+        submodule_path,
+        configuration.reporter_filepath,
+        configuration.relative_imports,
+    )
 
-    if configuration.relative_imports:
-        # TODO(zomglings): Check that common_ancestor is a subpath of repository. Raise error if it is not.
-        common_ancestor = os.path.commonpath(
-            [submodule_path, configuration.reporter_filepath]
-        )
-        common_ancestor_to_submodule_path = Path(
-            os.path.relpath(submodule_path, start=common_ancestor)
-        )
-        common_ancestor_to_reporter_relpath = Path(
-            os.path.relpath(configuration.reporter_filepath, start=common_ancestor)
-        )
+    return (
+        import_path,
+        configuration.relative_imports,
+        configuration.reporter_object_name,
+    )
 
-        num_dots = len(common_ancestor_to_submodule_path.parts) - 1
-        import_dots = "." * num_dots
 
-        common_ancestor_to_reporter_path_components = list(
-            common_ancestor_to_reporter_relpath.parts[:-1]
-        )
-        reporter_filename = common_ancestor_to_reporter_relpath.parts[-1]
-        reporter_basename, _ = os.path.splitext(reporter_filename)
-        common_ancestor_to_reporter_path_components.append(reporter_basename)
+@functools.lru_cache(maxsize=1)
+def _libcst_version() -> str:
+    return importlib.metadata.version("libcst")
 
-        import_path = (
-            f"{import_dots}.{'.'.join(common_ancestor_to_reporter_path_components)}"
-        )
-    else:
-        repository_to_reporter_path = Path(
-            os.path.relpath(configuration.reporter_filepath, start=repository)
-        )
-        repository_to_reporter_path_components = list(
-            repository_to_reporter_path.parts[:-1]
-        )
-        reporter_filename = repository_to_reporter_path.parts[-1]
-        reporter_basename, _ = os.path.splitext(reporter_filename)
-        repository_to_reporter_path_components.append(reporter_basename)
 
-        repository_name = os.path.basename(repository)
+def parse_module(source: bytes) -> cst.Module:
+    """
+    Parses the given source into a libcst Module.
 
-        import_path = (
-            f"{repository_name}.{'.'.join(repository_to_reporter_path_components)}"
-        )
+    If the INFESTOR_CACHE_DIR environment variable is set, parsed modules are pickled into that
+    directory keyed by the SHA256 hash of the source and the libcst version. Later runs load the
+    pickled module instead of parsing the same source again. Unreadable cache entries are ignored.
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+    if not cache_dir:
+        return cst.parse_module(source)
 
-    return (
-        import_path,
-        configuration.relative_imports,
-        configuration.reporter_object_name,
+    source_hash = hashlib.sha256(source).hexdigest()
+    cache_file = os.path.join(
+        cache_dir, f"{source_hash}-libcst-{_libcst_version()}.pickle"
     )
+    try:
+        with open(cache_file, "rb") as ifp:
+            cached_module = pickle.load(ifp)
+        if isinstance(cached_module, cst.Module):
+            return cached_module
+    except Exception:
+        pass
+
+    module = cst.parse_module(source)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with atomic_write(cache_file, mode="wb", overwrite=True) as ofp:
+            pickle.dump(module, ofp, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        logging.warning(f"Could not write syntax tree cache file ({cache_file}): {e}")
+    return module
 
 
 class PackageFileManager:
-    def __init__(self, repository: str, filepath: str):
+    def __init__(
+        self,
+        repository: str,
+        filepath: str,
+        configuration: Optional[InfestorConfiguration] = None,
+        source: Optional[bytes] = None,
+    ):
+        """
+        If the caller already knows the contents of the file at filepath (e.g. because
+        it just created it), it can pass them as source so that the file is not read
+        again.
+        """
         self.filepath = filepath
         self.repository = repository
-        self._load_file(filepath)
-
-    def _load_file(self, filepath: str):
+        self._load_file(filepath, configuration, source)
+
+    def _load_file(
+        self,
+        filepath: str,
+        configuration: Optional[InfestorConfiguration] = None,
+        source: Optional[bytes] = None,
+    ):
         (
             self.reporter_module_path,
             self.relative_imports,
             self.reporter_object_name,
-        ) = get_reporter_import_information(self.repository, filepath)
-        with open(filepath, "r") as ifp:
-            file_source = ifp.read()
-        self._visit(cst.parse_module(file_source))
+        ) = get_reporter_import_information(self.repository, filepath, configuration)
+        if source is None:
+            source = Path(filepath).read_bytes()
+        # libcst infers (and preserves) the file's encoding when it is given bytes,
+        # which saves decoding the source up front.
+        self._visit(parse_module(source))
 
     def _visit(self, module: cst.Module):
-        self.syntax_tree = cst.metadata.MetadataWrapper(module)
-        self.visitor = visitors.PackageFileVisitor(
+        self._module = module
+        # The metadata wrapper and the visitor are only rebuilt once they are needed
+        # again, so that a write which follows a mutation does not pay for them.
+        self.__dict__.pop("syntax_tree", None)
+        self.__dict__.pop("visitor", None)
+
+    @functools.cached_property
+    def syntax_tree(self) -> cst.metadata.MetadataWrapper:
+        # By default, MetadataWrapper deep copies the module so that every node in it is
+        # unique. Our modules come straight from the parser or from transformers which
+        # never insert the same node instance twice, so the copy can be skipped.
+        return cst.metadata.MetadataWrapper(self._module, unsafe_skip_copy=True)
+
+    @functools.cached_property
+    def visitor(self) -> "visitors.PackageFileVisitor":
+        visitor = visitors.PackageFileVisitor(
             self.reporter_module_path, self.relative_imports, self.reporter_object_name
         )
-        self.syntax_tree.visit(self.visitor)
+        self.syntax_tree.visit(visitor)
+        return visitor
 
     def get_code(self):
-        return self.syntax_tree.module.code
+        return self._module.code
 
     def write_to_file(self):
-        with open(self.filepath, "w") as ofp:
-            ofp.write(self.get_code())
+        Path(self.filepath).write_bytes(self._module.bytes)
 
     def is_reporter_imported(self) -> bool:
-        return (
-            self.visitor.ReporterImportedAt != -1
-            and self.visitor.ReporterImportedAs != ""
-        )
+        visitor = self.visitor
+        return visitor.ReporterImportedAt != -1 and visitor.ReporterImportedAs != ""
 
     def ensure_import_reporter(self):
         if not self.is_reporter_imported():
@@ -149,77 +240,123 @@ class PackageFileManager:
         modified_tree = self.syntax_tree.visit(transformer)
         self._visit(modified_tree)
 
-        if (
-            self.visitor.ReporterImportedAs == ""
-            or self.visitor.ReporterImportedAt == -1
-        ):
+        if not self.is_reporter_imported():
             raise GenerateReporterError(
                 f"Failed to import reporter \n{self.get_code()}"
             )
 
-    def get_calls(self, call_type):
-        return self.visitor.calls.get(call_type, [])
+    def get_calls(self, call_type: str) -> Tuple[models.ReporterCall, ...]:
+        # The visitor may be shared through the package file manager cache, so reading
+        # from it must neither add keys to its defaultdicts nor hand out its lists.
+        return tuple(self.visitor.calls.get(call_type, ()))
 
     def add_call(self, call_type):
         if self.get_calls(call_type):
             return
-        self.ensure_import_reporter()
+
+        modified_tree = self._module
+        reporter_imported_as = self.visitor.ReporterImportedAs
+        if not self.is_reporter_imported():
+            # Neither transformer needs metadata, and a freshly added import always
+            # binds the reporter to its own name. So we can add the import and the call
+            # in one go and only re-analyze the module once.
+            import_transformer = transformers.ImportReporterTransformer(
+                self.reporter_module_path, self.reporter_object_name
+            )
+            modified_tree = modified_tree.visit(import_transformer)
+            reporter_imported_as = self.reporter_object_name
+
         transformer = transformers.ReporterCallsAdderTransformer(
-            self.visitor.ReporterImportedAs, call_type
+            reporter_imported_as, call_type
         )
-        modified_tree = self.syntax_tree.visit(transformer)
+        modified_tree = modified_tree.visit(transformer)
         self._visit(modified_tree)
 
-    def remove_call(self, call_type: str):
+        if not self.is_reporter_imported():
+            raise GenerateReporterError(
+                f"Failed to import reporter \n{self.get_code()}"
+            )
+
+    def remove_call(self, call_type: str) -> bool:
+        """
+        Removes reporter calls of the given type. Returns True if any call was removed,
+        and False if the module was left unchanged.
+        """
+        if not self.is_reporter_imported():
+            # Without the reporter import there are no reporter calls to remove.
+            return False
+
+        reporter_imported_as = self.visitor.ReporterImportedAs
         transformer = transformers.ReporterCallsRemoverTransformer(
-            self.visitor.ReporterImportedAs, call_type
+            reporter_imported_as, call_type
         )
 
-        modified_tree = self.syntax_tree.visit(transformer)
+        # The transformer does not need metadata, so it can work on the bare module.
+        modified_tree = self._module.visit(transformer)
+        if not transformer.calls_removed:
+            return False
+
         self._visit(modified_tree)
+        return True
 
-    def list_decorators(self, decorator_type: str):
-        return self.visitor.decorators.get(decorator_type, [])
+    def list_decorators(
+        self, decorator_type: str
+    ) -> Tuple[models.ReporterDecorator, ...]:
+        # See get_calls.
+        return tuple(self.visitor.decorators.get(decorator_type, ()))
 
     def decorator_candidates(self, decorator_type: str):
-        decorator_candidates_visitor = visitors.DecoratorCandidatesVisitor(
-            self.visitor.ReporterImportedAs, decorator_type
-        )
-        self.syntax_tree.visit(decorator_candidates_visitor)
-        return decorator_candidates_visitor.decorator_candidates
+        return self.visitor.decorator_candidates(decorator_type)
 
     def add_decorators(self, decorator_type: str, linenos: List[int]):
-        func_linenos = linenos
-        if not self.is_reporter_imported():
-            # Reporter not importer, we need to add reporter
-            self.add_reporter_import()
-            # Since we added reporter, source has changed and
-            # all linenos need to be increased by 1
-            func_linenos = [x + 1 for x in func_linenos]
+        reporter_imported_as = self.visitor.ReporterImportedAs
+        reporter_imported = self.is_reporter_imported()
+        if not reporter_imported:
+            # A freshly added import always binds the reporter to its own name.
+            reporter_imported_as = self.reporter_object_name
 
-        transformer = transformers.DecoratorsAdderTransformer(
-            self.visitor.ReporterImportedAs, decorator_type, func_linenos
-        )
+        transformer: cst.CSTTransformer
+        if decorator_type == DECORATOR_TYPE_RECORD_ERRORS:
+            # Adds the decorators and the error reports in their except handlers in
+            # a single pass.
+            transformer = transformers.RecordErrorsAdderTransformer(
+                reporter_imported_as, decorator_type, linenos
+            )
+        else:
+            transformer = transformers.DecoratorsAdderTransformer(
+                reporter_imported_as, decorator_type, linenos
+            )
         modified_tree = self.syntax_tree.visit(transformer)
+
+        if not reporter_imported:
+            # The reporter is imported only after the decorators have been added, so
+            # that linenos still refer to the original source. The import transformer
+            # does not need metadata, so the module is only re-analyzed once.
+            import_transformer = transformers.ImportReporterTransformer(
+                self.reporter_module_path, self.reporter_object_name
+            )
+            modified_tree = modified_tree.visit(import_transformer)
+
         self._visit(modified_tree)
-        if decorator_type == DECORATOR_TYPE_RECORD_ERRORS:
-            # We've added decorator which shifts linenos
-            try_except_transformer = transformers.TryExceptAdderTransformer(
-                self.visitor.ReporterImportedAs, [x + 1 for x in func_linenos]
+
+        if not self.is_reporter_imported():
+            raise GenerateReporterError(
+                f"Failed to import reporter \n{self.get_code()}"
             )
-            modified_tree = self.syntax_tree.visit(try_except_transformer)
-            self._visit(modified_tree)
 
     def remove_decorators(self, decorator_type: str, linenos: List[int]):
-        transformer = transformers.DecoratorsRemoverTransformer(
-            self.visitor.ReporterImportedAs, decorator_type, linenos
-        )
-        modified_tree = self.syntax_tree.visit(transformer)
-        self._visit(modified_tree)
+        if not self.is_reporter_imported() or not linenos:
+            return
 
+        reporter_imported_as = self.visitor.ReporterImportedAs
+        transformer: cst.CSTTransformer
         if decorator_type == DECORATOR_TYPE_RECORD_ERRORS:
-            try_except_transformer = transformers.TryExceptRemoverTransformer(
-                self.visitor.ReporterImportedAs, [x - 1 for x in linenos]
+            transformer = transformers.RecordErrorsRemoverTransformer(
+                reporter_imported_as, decorator_type, linenos
+            )
+        else:
+            transformer = transformers.DecoratorsRemoverTransformer(
+                reporter_imported_as, decorator_type, linenos
             )
-            modified_tree = self.syntax_tree.visit(try_except_transformer)
-            self._visit(modified_tree)
+        modified_tree = self.syntax_tree.visit(transformer)
+        self._visit(modified_tree)
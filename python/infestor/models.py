@@ -1,19 +1,28 @@
-from pydantic import BaseModel
-from typing import List
+from dataclasses import dataclass
 
 
-class ReporterCall(BaseModel):
+# Slots are declared by hand since dataclass(slots=True) needs Python 3.10.
+@dataclass
+class ReporterCall:
+    __slots__ = ("call_type", "lineno", "scope_stack")
+
     call_type: str
     lineno: int
     scope_stack: str
 
 
-class ReporterDecorator(BaseModel):
+@dataclass
+class ReporterDecorator:
+    __slots__ = ("decorator_type", "lineno", "scope_stack")
+
     decorator_type: str
     lineno: int
     scope_stack: str
 
 
-class ReporterDecoratorCandidate(BaseModel):
+@dataclass
+class ReporterDecoratorCandidate:
+    __slots__ = ("scope_stack", "lineno")
+
     scope_stack: str
     lineno: int
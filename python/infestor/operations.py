@@ -1,6 +1,19 @@
-import logging
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import os
-from typing import cast, Dict, List, Optional, Sequence
+import re
+import string
+from typing import (
+    cast,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 from . import models
 from .errors import *
 from .manager import (
@@ -12,6 +25,8 @@ from .manager import (
 )
 from .config import (
     default_config_file,
+    get_config,
+    InfestorConfiguration,
     load_config,
     save_config,
     python_root_relative_to_repository_root,
@@ -19,34 +34,257 @@ from .config import (
 
 DEFAULT_REPORTER_FILENAME = "report.py"
 DEFAULT_REPORTER_OBJECT_NAME = "reporter"
-REPORTER_FILE_TEMPLATE: Optional[str] = None
 TEMPLATE_FILEPATH = os.path.join(os.path.dirname(__file__), "report.py.template")
+# Below this many files, starting worker processes costs more than it saves.
+PARALLEL_FILES_THRESHOLD = 32
+
+# Directories which python_files does not descend into. They never hold source files
+# which Infestor should manage, but can be large.
+SKIPPED_DIRECTORIES = frozenset(
+    [".git", "__pycache__", ".tox", ".venv", "venv", "node_modules"]
+)
+# Build output directories, which python_files only descends into if they are Python
+# packages themselves (i.e. contain an __init__.py file).
+BUILD_DIRECTORIES = frozenset(["build", "dist"])
+PYTHON_FILE_EXTENSIONS = (".py",)
+
+T = TypeVar("T")
+
+# Maximum number of package file managers (and so parsed modules) kept in memory.
+PACKAGE_FILE_MANAGER_CACHE_SIZE = 128
+
+# Maps (repository, filepath) to the stat signature of the file, the configuration the
+# manager was created with, and the manager itself. Entries are kept in the order in
+# which they were last used. See get_package_file_manager.
+_package_file_managers: Dict[
+    Tuple[str, str],
+    Tuple[Tuple[int, int, int], InfestorConfiguration, PackageFileManager],
+] = {}
 
-try:
-    with open(TEMPLATE_FILEPATH, "r") as ifp:
-        REPORTER_FILE_TEMPLATE = ifp.read()
-except Exception as e:
-    logging.warn(f"WARNING: Could not load reporter template from {TEMPLATE_FILEPATH}:")
-    logging.warn(e)
+
+@functools.lru_cache(maxsize=1)
+def _reporter_template() -> str:
+    """
+    Loads the reporter template the first time it is needed, so that only operations which
+    generate a reporter pay for reading it. Failures are not cached, so a later call tries
+    to load the template again.
+    """
+    try:
+        with open(TEMPLATE_FILEPATH, "r") as ifp:
+            return ifp.read()
+    except Exception as e:
+        raise GenerateReporterError(
+            f"Could not load reporter template file ({TEMPLATE_FILEPATH}): {e}"
+        ) from e
+
+
+@functools.lru_cache(maxsize=1)
+def _reporter_template_chunks() -> List[
+    Tuple[str, Optional[str], Optional[str], Optional[str]]
+]:
+    """
+    Parses the reporter template into (literal text, field name, format spec,
+    conversion) chunks once, so that rendering it does not parse the template again.
+    """
+    return list(string.Formatter().parse(_reporter_template()))
+
+
+def _render_reporter_template(values: Dict[str, str]) -> str:
+    formatter = string.Formatter()
+    pieces: List[str] = []
+    chunks = _reporter_template_chunks()
+    for literal_text, field_name, format_spec, conversion in chunks:
+        pieces.append(literal_text)
+        if field_name is not None:
+            value = formatter.convert_field(values[field_name], conversion)
+            pieces.append(format(value, format_spec or ""))
+    return "".join(pieces)
+
+
+def _skip_directory(entry: os.DirEntry) -> bool:
+    if entry.name in SKIPPED_DIRECTORIES or entry.is_symlink():
+        return True
+    if entry.name in BUILD_DIRECTORIES:
+        return not os.path.isfile(os.path.join(entry.path, "__init__.py"))
+    return False
 
 
 def python_files(repository: str) -> Sequence[str]:
+    """
+    Lists the Python files under the given repository, in the same order as a top-down
+    os.walk would.
+
+    Directory entries are classified by the file type which os.scandir reports along with
+    each name, so (on most platforms) no file needs to be stat-ed. As with os.walk,
+    symbolic links to directories are not followed and unreadable directories are
+    skipped. Directories named in SKIPPED_DIRECTORIES are not descended into, and nor
+    are directories named in BUILD_DIRECTORIES which are not Python packages.
+    """
     results: List[str] = []
     if os.path.isfile(repository):
         return [repository]
 
-    for dirpath, _, filenames in os.walk(repository, topdown=True):
-        results.extend(
-            [
-                os.path.join(dirpath, filename)
-                for filename in filenames
-                if filename.endswith(".py")
-            ]
-        )
+    directories = [repository]
+    while directories:
+        directory = directories.pop()
+        subdirectories: List[str] = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not _skip_directory(entry):
+                            subdirectories.append(entry.path)
+                    elif entry.name.endswith(PYTHON_FILE_EXTENSIONS):
+                        results.append(entry.path)
+        except OSError:
+            continue
+        # Subdirectories are popped off the end, so push them in reverse order to visit
+        # them in the order in which they were listed.
+        directories.extend(reversed(subdirectories))
 
     return results
 
 
+@functools.lru_cache(maxsize=None)
+def _reporter_import_pattern(reporter_object_name: str) -> Pattern[bytes]:
+    return re.compile(
+        rb"(?:^|;)[ \t]*from[ \t]+[\w.]+[ \t]+import[ \t]+"
+        + re.escape(reporter_object_name.encode())
+        + rb"\b",
+        re.MULTILINE,
+    )
+
+
+def may_import_reporter(
+    filepath: str, reporter_object_name: str, attribute_name: Optional[str] = None
+) -> bool:
+    """
+    Cheap check on the raw bytes of a file for whether it could import the reporter object. Files
+    which do not import the reporter object cannot contain reporter calls or decorators, so there
+    is no need to parse them.
+
+    If attribute_name is given (e.g. a call or decorator type), files which do not
+    mention it anywhere are also rejected, since they cannot use that attribute of the
+    reporter. This substring test is cheaper than the search for the import, so it is
+    done first.
+
+    This may return True for files which do not actually import the reporter, but never returns
+    False for a file which does.
+    """
+    with open(filepath, "rb") as ifp:
+        source = ifp.read()
+    if attribute_name is not None and attribute_name.encode() not in source:
+        return False
+    return _reporter_import_pattern(reporter_object_name).search(source) is not None
+
+
+def get_package_file_manager(
+    repository: str,
+    filepath: str,
+    configuration: Optional[InfestorConfiguration] = None,
+    for_update: bool = False,
+) -> PackageFileManager:
+    """
+    Returns a PackageFileManager for the file at the given filepath. Files are only
+    parsed again if they (or the repository configuration) have changed since the last
+    time a manager was requested for them.
+
+    Managers are shared between callers, so callers which intend to modify the file must
+    pass for_update=True. The manager is then removed from the cache and belongs to the
+    caller. At most PACKAGE_FILE_MANAGER_CACHE_SIZE managers are cached; the least
+    recently used ones are dropped first.
+    """
+    if configuration is None:
+        configuration = get_config(repository)
+
+    stat = os.stat(filepath)
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    key = (repository, filepath)
+
+    package_file_manager: Optional[PackageFileManager] = None
+    cached = _package_file_managers.pop(key, None)
+    if cached is not None:
+        cached_signature, cached_configuration, cached_manager = cached
+        if cached_signature == signature and cached_configuration is configuration:
+            package_file_manager = cached_manager
+
+    if package_file_manager is None:
+        package_file_manager = PackageFileManager(repository, filepath, configuration)
+
+    if not for_update:
+        _package_file_managers[key] = (signature, configuration, package_file_manager)
+        # Evict the least recently used managers, so that listing a large repository
+        # does not keep every one of its modules in memory.
+        while len(_package_file_managers) > PACKAGE_FILE_MANAGER_CACHE_SIZE:
+            del _package_file_managers[next(iter(_package_file_managers))]
+    return package_file_manager
+
+
+def clear_caches() -> None:
+    """
+    Drops all cached package file managers and compiled reporter import patterns.
+    """
+    _package_file_managers.clear()
+    _reporter_import_pattern.cache_clear()
+
+
+def _process_file(
+    repository: str,
+    configuration: InfestorConfiguration,
+    operation: Callable[[PackageFileManager], T],
+    for_update: bool,
+    filepath: str,
+) -> T:
+    package_file_manager = get_package_file_manager(
+        repository, filepath, configuration, for_update=for_update
+    )
+    return operation(package_file_manager)
+
+
+def process_files(
+    repository: str,
+    filepaths: Sequence[str],
+    operation: Callable[[PackageFileManager], T],
+    configuration: Optional[InfestorConfiguration] = None,
+    for_update: bool = True,
+) -> List[T]:
+    """
+    Applies the given operation to a PackageFileManager for each of the given files and
+    returns the results in the same order as the files. Operations which only read from
+    their managers should pass for_update=False (see get_package_file_manager).
+
+    Files are independent of each other, so when there are at least
+    PARALLEL_FILES_THRESHOLD of them they are processed in a pool of worker processes.
+    In that case, the operation must be picklable (e.g. a module-level function or a
+    functools.partial of one).
+    """
+    if configuration is None:
+        configuration = get_config(repository)
+
+    process_file = functools.partial(
+        _process_file, repository, configuration, operation, for_update
+    )
+    if len(filepaths) < PARALLEL_FILES_THRESHOLD:
+        return [process_file(filepath) for filepath in filepaths]
+
+    max_workers = os.cpu_count() or 1
+    chunksize = max(1, len(filepaths) // (4 * max_workers))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(process_file, filepaths, chunksize=chunksize))
+
+
+def _get_calls(
+    call_type: str, package_file_manager: PackageFileManager
+) -> List[models.ReporterCall]:
+    # Managers read for listings stay cached, so callers get their own copy of the
+    # listing rather than the one the manager holds.
+    return list(package_file_manager.get_calls(call_type))
+
+
 def list_calls(
     call_type: str,
     repository: str,
@@ -62,9 +300,23 @@ def list_calls(
     if candidate_files is None:
         candidate_files = python_files(repository)
 
-    for filepath in candidate_files:
-        package_file_manager = PackageFileManager(repository, filepath)
-        calls = package_file_manager.get_calls(call_type)
+    configuration = get_config(repository)
+    if configuration.reporter_filepath is None:
+        raise GenerateReporterError("No reporter defined for project.")
+
+    filepaths = [
+        filepath
+        for filepath in candidate_files
+        if may_import_reporter(filepath, configuration.reporter_object_name, call_type)
+    ]
+    files_calls = process_files(
+        repository,
+        filepaths,
+        functools.partial(_get_calls, call_type),
+        configuration,
+        for_update=False,
+    )
+    for filepath, calls in zip(filepaths, files_calls):
         if calls:
             results[filepath] = calls
 
@@ -89,15 +341,25 @@ def add_call(
         if os.path.isdir(target_file):
             target_file = os.path.join(target_file, "__init__.py")
 
-    if not os.path.exists(target_file):
-        with open(target_file, "w") as ofp:
-            ofp.write("")
-
-    package_file_manager = PackageFileManager(repository, target_file)
+    package_file_manager: PackageFileManager
+    try:
+        os.close(os.open(target_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+    except FileExistsError:
+        package_file_manager = get_package_file_manager(
+            repository, target_file, for_update=True
+        )
+    else:
+        # We just created the file, so there is no need to read it back.
+        package_file_manager = PackageFileManager(repository, target_file, source=b"")
     package_file_manager.add_call(call_type)
     package_file_manager.write_to_file()
 
 
+def _remove_call(call_type: str, package_file_manager: PackageFileManager) -> None:
+    if package_file_manager.remove_call(call_type):
+        package_file_manager.write_to_file()
+
+
 def remove_calls(
     call_type: str,
     repository: str,
@@ -116,10 +378,28 @@ def remove_calls(
     else:
         candidate_files = [submodule_path]
 
-    for candidate_file in candidate_files:
-        package_file_manager = PackageFileManager(repository, candidate_file)
-        package_file_manager.remove_call(call_type)
-        package_file_manager.write_to_file()
+    configuration = get_config(repository)
+    if configuration.reporter_filepath is None:
+        raise GenerateReporterError("No reporter defined for project.")
+
+    filepaths = [
+        filepath
+        for filepath in candidate_files
+        if may_import_reporter(filepath, configuration.reporter_object_name, call_type)
+    ]
+    process_files(
+        repository,
+        filepaths,
+        functools.partial(_remove_call, call_type),
+        configuration,
+    )
+
+
+def _list_decorators(
+    decorator_type: str, package_file_manager: PackageFileManager
+) -> List[models.ReporterDecorator]:
+    # See _get_calls.
+    return list(package_file_manager.list_decorators(decorator_type))
 
 
 def list_decorators(
@@ -142,11 +422,27 @@ def list_decorators(
     if candidate_files is None:
         candidate_files = python_files(repository)
 
-    for candidate_file in candidate_files:
-        package_file_manager = PackageFileManager(repository, candidate_file)
-        decorators = package_file_manager.list_decorators(decorator_type)
+    configuration = get_config(repository)
+    if configuration.reporter_filepath is None:
+        raise GenerateReporterError("No reporter defined for project.")
+
+    filepaths = [
+        candidate_file
+        for candidate_file in candidate_files
+        if may_import_reporter(
+            candidate_file, configuration.reporter_object_name, decorator_type
+        )
+    ]
+    files_decorators = process_files(
+        repository,
+        filepaths,
+        functools.partial(_list_decorators, decorator_type),
+        configuration,
+        for_update=False,
+    )
+    for filepath, decorators in zip(filepaths, files_decorators):
         if decorators:
-            results[candidate_file] = decorators
+            results[filepath] = decorators
 
     return results
 
@@ -171,7 +467,7 @@ def decorator_candidates(
     This list is the list of candidate function definitions that the user could decorate (i.e. the ones which
     do not already have a decorator of the given decorator_type).
     """
-    package_file_manager = PackageFileManager(repository, submodule_path)
+    package_file_manager = get_package_file_manager(repository, submodule_path)
     return package_file_manager.decorator_candidates(decorator_type)
 
 
@@ -188,20 +484,20 @@ def add_decorators(
     2. submodule_path: Path (relative to python_root) of file in which we want to add a sytem_report
     3. linenos: Line numbers where functions are defined that we wish to decorate
     """
+    package_file_manager = get_package_file_manager(
+        repository, submodule_path, for_update=True
+    )
+    candidates = package_file_manager.decorator_candidates(decorator_type)
 
-    candidates = decorator_candidates(decorator_type, repository, submodule_path)
-
-    candidate_linenos = []
-    for candidate in candidates:
-        candidate_linenos.append(candidate.lineno)
-
-    for lineno in linenos:
-        if lineno not in candidate_linenos:
-            raise GenerateDecoratorError(
-                f"Non-candidate source code: submodule_path={submodule_path}, lineno={lineno}"
-            )
+    candidate_linenos = frozenset(candidate.lineno for candidate in candidates)
+    invalid_lineno = next(
+        (lineno for lineno in linenos if lineno not in candidate_linenos), None
+    )
+    if invalid_lineno is not None:
+        raise GenerateDecoratorError(
+            f"Non-candidate source code: submodule_path={submodule_path}, lineno={invalid_lineno}"
+        )
 
-    package_file_manager = PackageFileManager(repository, submodule_path)
     package_file_manager.add_decorators(decorator_type, linenos)
     package_file_manager.write_to_file()
 
@@ -219,35 +515,59 @@ def remove_decorators(
     2. submodule_path: Path (relative to python_root) of file in which we want to add a sytem_report
     3. linenos: Line numbers where decorated functions are defined that we wish to undecorate
     """
-    candidates_for_removal = list_decorators(
-        decorator_type, repository, [submodule_path]
-    ).get(submodule_path, [])
-
-    candidate_linenos = []
-    for candidate in candidates_for_removal:
-        candidate_linenos.append(candidate.lineno)
+    package_file_manager = get_package_file_manager(
+        repository, submodule_path, for_update=True
+    )
+    candidates_for_removal = package_file_manager.list_decorators(decorator_type)
 
-    for lineno in linenos:
-        if lineno not in candidate_linenos:
-            raise GenerateDecoratorError(
-                f"Could not undecorate invalid code at: submodule_path={submodule_path}, lineno={lineno}"
-            )
+    candidate_linenos = frozenset(
+        candidate.lineno for candidate in candidates_for_removal
+    )
+    invalid_lineno = next(
+        (lineno for lineno in linenos if lineno not in candidate_linenos), None
+    )
+    if invalid_lineno is not None:
+        raise GenerateDecoratorError(
+            f"Could not undecorate invalid code at: submodule_path={submodule_path}, lineno={invalid_lineno}"
+        )
 
-    package_file_manager = PackageFileManager(repository, submodule_path)
     package_file_manager.remove_decorators(decorator_type, linenos)
     package_file_manager.write_to_file()
 
 
+def _is_within_directory(directory: str, filepath: str) -> bool:
+    """
+    Checks, path component by path component, whether filepath lies under directory.
+    Unlike a plain string prefix check, this does not consider "pkg2/report.py" to be
+    under "pkg".
+    """
+    try:
+        common_path = os.path.commonpath([directory, filepath])
+    except ValueError:
+        # Raised when mixing absolute and relative paths, or paths on different drives.
+        return False
+    return common_path == os.path.normpath(directory)
+
+
 def add_reporter(
     repository: str,
     reporter_filepath: Optional[str] = None,
     force: bool = False,
+    configuration: Optional[InfestorConfiguration] = None,
 ) -> None:
-    if REPORTER_FILE_TEMPLATE is None:
-        raise GenerateReporterError("Could not load reporter template file")
+    """
+    Generates the reporter file for the given repository and records its path in the
+    repository configuration.
+
+    Callers which have just loaded (or modified) the configuration can pass it in to
+    avoid loading it again. It is updated in place and saved to the configuration file.
+    """
+    # Fail on a missing template before touching the configuration or the filesystem.
+    _reporter_template_chunks()
 
     config_file = default_config_file(repository)
-    configuration = load_config(config_file)
+    if configuration is None:
+        configuration = load_config(config_file)
 
     if reporter_filepath is None:
         if configuration.reporter_filepath is not None:
@@ -268,7 +588,7 @@ def add_reporter(
     # If the repository is not a prefix, we prepend the repository path to the reporter_filepath to
     # make it so.
     # TODO(zomglings): This could cause errors in the future, and we should clean this up.
-    if os.path.commonprefix([repository, reporter_filepath]) != repository:
+    if not _is_within_directory(repository, reporter_filepath):
         reporter_filepath = os.path.join(repository, reporter_filepath)
 
     if (not force) and os.path.exists(reporter_filepath):
@@ -279,10 +599,12 @@ def add_reporter(
     if configuration.reporter_token is None:
         raise GenerateReporterError("No reporter token was specified in configuration")
 
-    contents = REPORTER_FILE_TEMPLATE.format(
-        project_name=configuration.project_name,
-        reporter_object_name=configuration.reporter_object_name,
-        reporter_token=configuration.reporter_token,
+    contents = _render_reporter_template(
+        {
+            "project_name": configuration.project_name,
+            "reporter_object_name": configuration.reporter_object_name,
+            "reporter_token": configuration.reporter_token,
+        }
     )
     with open(reporter_filepath, "w") as ofp:
         ofp.write(contents)
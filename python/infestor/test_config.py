@@ -1,7 +1,5 @@
-from dataclasses import asdict
 import json
 import os
-import shutil
 import tempfile
 import unittest
 
@@ -67,11 +65,12 @@ class TestParseConfig(unittest.TestCase):
 
 class TestInit(unittest.TestCase):
     def setUp(self):
-        self.repository = tempfile.mkdtemp()
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.repository = self.temporary_directory.name
         self.project_name = "my-awesome-python-project"
 
     def tearDown(self):
-        shutil.rmtree(self.repository)
+        self.temporary_directory.cleanup()
 
     def test_initialize_infestor_once(self):
         configuration = config.initialize(self.repository, self.project_name)
@@ -79,7 +78,7 @@ class TestInit(unittest.TestCase):
         self.assertTrue(os.path.isfile(config_file))
         with open(config_file, "r") as ifp:
             configuration_json = json.load(ifp)
-        self.assertDictEqual(configuration_json, asdict(configuration))
+        self.assertDictEqual(configuration_json, configuration.to_dict())
 
     def test_initialize_infestor_twice(self):
         initial_configuration = config.initialize(
@@ -94,7 +93,7 @@ class TestInit(unittest.TestCase):
         with open(config_file, "r") as ifp:
             configuration_json = json.load(ifp)
 
-        self.assertDictEqual(configuration_json, asdict(final_configuration))
+        self.assertDictEqual(configuration_json, final_configuration.to_dict())
 
 
 if __name__ == "__main__":
@@ -50,6 +50,16 @@ class TestGetReporterImportInformationFromComplexConfiguration(unittest.TestCase
         self.assertTrue(is_relative)
         self.assertEqual(reporter_object_name, self.reporter_object_name)
 
+    def test_reporter_import_information_from_relative_configuration_same_dir(self):
+        for submodule_path in [
+            "test_project/utils/other.py",
+            "test_project/utils/reporter.py",
+        ]:
+            reporter_import_path, _, _ = manager.get_reporter_import_information(
+                self.repository, submodule_path, self.relative_configuration
+            )
+            self.assertEqual(reporter_import_path, ".reporter")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,9 @@
 import json
 import os
 import unittest
-import libcst as cst
 from . import operations
 from . import visitors
-from .testcase import InfestorTestCase
+from .testcase import InfestorTestCase, metadata_wrapper, parse_source
 
 
 class TestSetupReporter(InfestorTestCase):
@@ -35,10 +34,22 @@ class TestSetupReporter(InfestorTestCase):
         self.assertEqual(infestor_json_new["reporter_filepath"], reporter_filepath)
         self.assertTrue(os.path.exists(reporter_filepath))
 
-        reporter_visitor = visitors.ReporterFileVisitor()
-        reporter_syntax_tree = reporter_visitor.syntax_tree(reporter_filepath)
+        # Cheap checks first, so that a broken reporter file fails without being parsed.
+        with open(reporter_filepath, "rb") as ifp:
+            reporter_source = ifp.read()
+        self.assertIn(b"HumbugConsent", reporter_source)
+        self.assertIn(b"HumbugReporter", reporter_source)
+        self.assertIn(infestor_json_new["reporter_token"].encode(), reporter_source)
+
+        # The generated reporter file should match the golden file exactly.
+        with open(os.path.join(self.fixtures_dir, "report.py.golden"), "rb") as ifp:
+            expected_reporter_source = ifp.read().replace(
+                b"{{TOKEN}}", self.reporter_token.encode()
+            )
+        self.assertEqual(reporter_source, expected_reporter_source)
 
-        reporter_syntax_tree.visit(reporter_visitor)
+        reporter_visitor = visitors.ReporterFileVisitor()
+        parse_source(reporter_source).visit(reporter_visitor)
 
         self.assertEqual(reporter_visitor.HumbugConsentImportedAs, "HumbugConsent")
         self.assertLess(
@@ -58,6 +69,20 @@ class TestSetupReporter(InfestorTestCase):
             f"\"{infestor_json_new['reporter_token']}\"",
         )
 
+    def test_add_reporter_with_configuration(self):
+        self.config.reporter_token = "passed-in-token"
+        operations.add_reporter(self.package_dir, configuration=self.config)
+
+        reporter_filepath = os.path.join(
+            self.package_dir, operations.DEFAULT_REPORTER_FILENAME
+        )
+        with open(self.config_file, "r") as ifp:
+            infestor_json = json.load(ifp)
+        self.assertEqual(infestor_json["reporter_filepath"], reporter_filepath)
+        self.assertEqual(infestor_json["reporter_token"], "passed-in-token")
+        with open(reporter_filepath, "r") as ifp:
+            self.assertIn("passed-in-token", ifp.read())
+
     def test_system_report_add_with_no_reporter_added(self):
         with self.assertRaises(operations.GenerateReporterError):
             operations.add_call(
@@ -71,14 +96,14 @@ class TestSetupReporter(InfestorTestCase):
             operations.CALL_TYPE_SYSTEM_REPORT,
             self.package_dir,
         )
-        self.assertDictEqual(results, {})
+        self.assertEqual(len(results), 0, results)
 
     def test_decorator_list_with_no_reporter_decorators(self):
         operations.add_reporter(self.package_dir)
         results = operations.list_decorators(
             operations.DECORATOR_TYPE_RECORD_ERRORS, self.package_dir
         )
-        self.assertDictEqual(results, {})
+        self.assertEqual(len(results), 0, results)
 
     def test_decorator_add_remove(self):
         operations.add_reporter(self.package_dir)
@@ -131,7 +156,54 @@ class TestSetupReporter(InfestorTestCase):
             operations.DECORATOR_TYPE_RECORD_ERRORS, self.package_dir, [target_file]
         )
 
-        self.assertEqual(decorators, {}, "Failed to remove decorators")
+        self.assertEqual(len(decorators), 0, "Failed to remove decorators")
+
+    def test_record_errors_add_remove_multiple_functions(self):
+        operations.add_reporter(self.package_dir)
+        target_file = os.path.join(self.package_dir, "handlers.py")
+        with open(target_file, "w") as ofp:
+            for name in ["first", "second", "third"]:
+                ofp.write(
+                    f"def {name}():\n"
+                    "    try:\n"
+                    "        pass\n"
+                    "    except Exception as err:\n"
+                    "        pass\n\n\n"
+                )
+
+        candidates = operations.decorator_candidates(
+            operations.DECORATOR_TYPE_RECORD_ERRORS, self.package_dir, target_file
+        )
+        self.assertEqual(len(candidates), 3)
+
+        operations.add_decorators(
+            operations.DECORATOR_TYPE_RECORD_ERRORS,
+            self.package_dir,
+            target_file,
+            [candidate.lineno for candidate in candidates],
+        )
+        with open(target_file, "r") as ifp:
+            source = ifp.read()
+        self.assertEqual(source.count("@reporter.record_errors"), 3)
+        self.assertEqual(
+            source.count("reporter.error_report(err)"),
+            3,
+            "Failed to report errors in every decorated function",
+        )
+
+        decorators = operations.list_decorators(
+            operations.DECORATOR_TYPE_RECORD_ERRORS, self.package_dir, [target_file]
+        )
+        operations.remove_decorators(
+            operations.DECORATOR_TYPE_RECORD_ERRORS,
+            self.package_dir,
+            target_file,
+            [decorator.lineno for decorator in decorators[target_file]],
+        )
+        with open(target_file, "r") as ifp:
+            source = ifp.read()
+        self.assertNotIn("@reporter.record_errors", source)
+        self.assertNotIn("reporter.error_report(err)", source)
 
     def test_system_report_add(self):
         operations.add_reporter(self.package_dir)
@@ -139,12 +211,8 @@ class TestSetupReporter(InfestorTestCase):
 
         target_file = os.path.join(self.package_dir, "__init__.py")
 
-        source = ""
-        with open(target_file, "r") as ifp:
-            for line in ifp:
-                source += line
-
-        source_tree = cst.metadata.MetadataWrapper(cst.parse_module(source))
+        with open(target_file, "rb") as ifp:
+            source_tree = metadata_wrapper(ifp.read())
         visitor = visitors.PackageFileVisitor(self.package_name + ".report", False)
         source_tree.visit(visitor)
 
@@ -177,11 +245,174 @@ class TestSetupReporter(InfestorTestCase):
         )
         self.assertNotEqual(calls, {}, "Failed to add system_report call")
 
+        untouched_file = os.path.join(self.package_dir, "cli.py")
+        untouched_mtime_ns = os.stat(untouched_file).st_mtime_ns
+
         operations.remove_calls(operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir)
         calls = operations.list_calls(
             operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir
         )
-        self.assertEqual(calls, {}, "Failed to remove system_report call")
+        self.assertEqual(len(calls), 0, "Failed to remove system_report call")
+        self.assertEqual(
+            os.stat(untouched_file).st_mtime_ns,
+            untouched_mtime_ns,
+            "Rewrote a file without system_report calls",
+        )
+
+    def test_system_report_remove_in_parallel(self):
+        operations.add_reporter(self.package_dir)
+        for i in range(operations.PARALLEL_FILES_THRESHOLD):
+            operations.add_call(
+                operations.CALL_TYPE_SYSTEM_REPORT,
+                self.package_dir,
+                os.path.join(self.package_dir, f"module_{i}.py"),
+            )
+        calls = operations.list_calls(
+            operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir
+        )
+        self.assertEqual(len(calls), operations.PARALLEL_FILES_THRESHOLD)
+
+        operations.remove_calls(operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir)
+        calls = operations.list_calls(
+            operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir
+        )
+        self.assertEqual(len(calls), 0, "Failed to remove system_report calls")
+
+
+class TestPythonFiles(InfestorTestCase):
+    def test_python_files_skips_environments_and_build_output(self):
+        # A subpackage which happens to be called "build" is still listed.
+        expected_files = [os.path.join(self.package_dir, "build", "__init__.py")]
+        skipped_files = [
+            os.path.join(self.package_dir, ".venv", "lib", "module.py"),
+            os.path.join(self.repository, "build", "lib", "a_package", "cli.py"),
+            os.path.join(self.repository, "dist", "module.py"),
+        ]
+        for filepath in expected_files + skipped_files:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with open(filepath, "w") as ofp:
+                ofp.write("")
+
+        files = operations.python_files(self.repository)
+        for filepath in expected_files:
+            self.assertIn(filepath, files)
+        for filepath in skipped_files:
+            self.assertNotIn(filepath, files)
+
+
+class TestIsWithinDirectory(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join("repository", "pkg")
+
+    def test_file_in_directory(self):
+        self.assertTrue(
+            operations._is_within_directory(
+                self.directory, os.path.join(self.directory, "report.py")
+            )
+        )
+
+    def test_file_in_sibling_directory_sharing_prefix(self):
+        # "repository/pkg2" starts with "repository/pkg", but is not under it.
+        self.assertFalse(
+            operations._is_within_directory(
+                self.directory, os.path.join("repository", "pkg2", "report.py")
+            )
+        )
+
+
+class TestPackageFileManagerCache(InfestorTestCase):
+    def setUp(self):
+        super().setUp()
+        operations.add_reporter(self.package_dir)
+        self.target_file = os.path.join(self.package_dir, "cli.py")
+
+    def tearDown(self) -> None:
+        operations.clear_caches()
+        super().tearDown()
+
+    def test_manager_reused_until_file_changes(self):
+        package_file_manager = operations.get_package_file_manager(
+            self.package_dir, self.target_file
+        )
+        self.assertIs(
+            operations.get_package_file_manager(self.package_dir, self.target_file),
+            package_file_manager,
+        )
+
+        with open(self.target_file, "a") as ofp:
+            ofp.write("\nx = 1\n")
+        self.assertIsNot(
+            operations.get_package_file_manager(self.package_dir, self.target_file),
+            package_file_manager,
+        )
+
+    def test_manager_for_update_is_not_shared(self):
+        package_file_manager = operations.get_package_file_manager(
+            self.package_dir, self.target_file
+        )
+        self.assertIs(
+            operations.get_package_file_manager(
+                self.package_dir, self.target_file, for_update=True
+            ),
+            package_file_manager,
+        )
+        self.assertIsNot(
+            operations.get_package_file_manager(self.package_dir, self.target_file),
+            package_file_manager,
+        )
+
+    def test_listing_mutations_do_not_reach_cache(self):
+        operations.add_call(operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir)
+        calls = operations.list_calls(
+            operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir
+        )
+        self.assertEqual(len(calls), 1)
+        for file_calls in calls.values():
+            file_calls.clear()
+
+        calls_again = operations.list_calls(
+            operations.CALL_TYPE_SYSTEM_REPORT, self.package_dir
+        )
+        self.assertEqual(calls_again.keys(), calls.keys())
+        for file_calls in calls_again.values():
+            self.assertEqual(len(file_calls), 1)
+
+    def test_manager_listings_do_not_change_visitor(self):
+        package_file_manager = operations.get_package_file_manager(
+            self.package_dir, self.target_file
+        )
+        visitor = package_file_manager.visitor
+        self.assertEqual(
+            package_file_manager.get_calls(operations.CALL_TYPE_SYSTEM_REPORT), ()
+        )
+        self.assertEqual(
+            package_file_manager.list_decorators(
+                operations.DECORATOR_TYPE_RECORD_ERRORS
+            ),
+            (),
+        )
+        self.assertNotIn(operations.CALL_TYPE_SYSTEM_REPORT, visitor.calls)
+        self.assertNotIn(operations.DECORATOR_TYPE_RECORD_ERRORS, visitor.decorators)
+
+    def test_cache_is_bounded(self):
+        init_file = os.path.join(self.package_dir, "__init__.py")
+        cache_size = operations.PACKAGE_FILE_MANAGER_CACHE_SIZE
+        operations.PACKAGE_FILE_MANAGER_CACHE_SIZE = 1
+        try:
+            operations.get_package_file_manager(self.package_dir, self.target_file)
+            package_file_manager = operations.get_package_file_manager(
+                self.package_dir, init_file
+            )
+        finally:
+            operations.PACKAGE_FILE_MANAGER_CACHE_SIZE = cache_size
+
+        self.assertEqual(
+            list(operations._package_file_managers), [(self.package_dir, init_file)]
+        )
+        self.assertIs(
+            operations.get_package_file_manager(self.package_dir, init_file),
+            package_file_manager,
+        )
 
 
 if __name__ == "__main__":
@@ -1,10 +1,11 @@
-import os
 import unittest
 
+import libcst as cst
+
 from . import config
 from . import visitors
 from .operations import add_reporter
-from .testcase import InfestorTestCase
+from .testcase import InfestorTestCase, parse_source
 
 
 class TestReporterFileVisitor(InfestorTestCase):
@@ -15,10 +16,9 @@ class TestReporterFileVisitor(InfestorTestCase):
 
     def test_visitor(self):
         visitor = visitors.ReporterFileVisitor()
-        syntax_tree = visitor.syntax_tree(
-            os.path.join(self.package_dir, self.config.reporter_filepath)
-        )
-        syntax_tree.visit(visitor)
+        # reporter_filepath is stored with the repository path as a prefix.
+        with open(self.config.reporter_filepath, "rb") as ifp:
+            parse_source(ifp.read()).visit(visitor)
         self.assertEqual(visitor.HumbugConsentImportedAs, "HumbugConsent")
         self.assertEqual(visitor.HumbugConsentInstantiatedAs, "consent")
         self.assertGreater(visitor.HumbugConsentImportedAt, 0)
@@ -40,6 +40,27 @@ class TestReporterFileVisitor(InfestorTestCase):
             visitor.HumbugReporterConsentArgument, visitor.HumbugConsentInstantiatedAs
         )
         self.assertNotEqual(visitor.HumbugReporterTokenArgument, "")
+        self.assertTrue(visitor.done())
+
+
+class TestDispatchTableVisitor(unittest.TestCase):
+    def test_dispatch_and_pruning(self):
+        class NameVisitor(visitors.DispatchTableVisitor):
+            PRUNED_NODE_TYPES = (cst.Arg,)
+
+            def __init__(self):
+                self.names = []
+
+            def visit_Name(self, node: cst.Name):
+                self.names.append(node.value)
+
+        self.assertEqual(NameVisitor.VISIT_DISPATCH[cst.Arg], visitors.skip_subtree)
+        self.assertEqual(NameVisitor.LEAVE_DISPATCH, {})
+
+        visitor = NameVisitor()
+        cst.parse_module("f(x)\ny = z\n").visit(visitor)
+        # x is an argument, so it is not visited.
+        self.assertEqual(visitor.names, ["f", "y", "z"])
 
 
 # TODO(yhtiyar): Write some tests for PackageFileVisitor. :)
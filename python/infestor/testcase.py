@@ -1,66 +1,175 @@
+import atexit
 import enum
-import glob
+import functools
 import os
 import shutil
 import sys
 import tempfile
 import unittest
+from typing import Optional
 import uuid
 
+import libcst as cst
+import libcst.metadata
 import pygit2
 
 from . import commit
 from . import config
 
+# Set this environment variable to a directory to create test repositories in it. If it
+# is not set, test repositories are created in /dev/shm when it is available, so that
+# they live in memory.
+TEST_TMPFS_ENV_VAR = "INFESTOR_TEST_TMPFS"
 
-class InfestorTestCase(unittest.TestCase):
-    def setUp(self):
-        self.repository = tempfile.mkdtemp()
-        pygit2.init_repository(self.repository, False)
 
-        self.fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+def temporary_directory_root() -> Optional[str]:
+    tmpfs = os.environ.get(TEST_TMPFS_ENV_VAR)
+    if tmpfs:
+        return tmpfs
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK | os.X_OK):
+        return "/dev/shm"
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def graveyard(root: Optional[str]) -> str:
+    """
+    Returns a directory under root into which test repositories are moved once the tests
+    are done with them. It is only deleted when the test process exits.
+    """
+    path = tempfile.mkdtemp(prefix=f"infestor-{os.getpid()}-graveyard-", dir=root)
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+
+def remove_directory(path: str, root: Optional[str]) -> None:
+    """
+    Removes the given directory (which was created under root). Renaming it into the
+    graveyard is much cheaper than deleting the many small files in a git repository one
+    by one. If it cannot be renamed, it is deleted right away.
+    """
+    try:
+        os.rename(path, os.path.join(graveyard(root), os.path.basename(path)))
+    except OSError:
+        shutil.rmtree(path)
+
 
-        script_basename = "a_script.py"
-        script_file_fixture = os.path.join(self.fixtures_dir, script_basename)
-        self.script_file = os.path.join(self.repository, script_basename)
-        shutil.copyfile(script_file_fixture, self.script_file)
+@functools.lru_cache(maxsize=32)
+def parse_source(source: bytes) -> cst.Module:
+    """
+    Parses the given source. Syntax trees are immutable, so tests which parse the same
+    source (e.g. the reporter module generated for each test) can share one tree.
+    """
+    return cst.parse_module(source)
 
-        package_basename = "a_package"
-        package_dir_fixture = os.path.join(self.fixtures_dir, package_basename)
-        self.package_dir = os.path.join(self.repository, package_basename)
-        shutil.copytree(package_dir_fixture, self.package_dir)
 
-        self.package_name = "a_package"
+@functools.lru_cache(maxsize=32)
+def metadata_wrapper(source: bytes) -> cst.metadata.MetadataWrapper:
+    """
+    Wraps the (shared) syntax tree for the given source for metadata resolution. The
+    tree comes straight from the parser, so the wrapper need not copy it. Resolved
+    metadata is kept on the wrapper, so tests which inspect the same source share it.
+    """
+    return cst.metadata.MetadataWrapper(parse_source(source), unsafe_skip_copy=True)
 
-        self.reporter_token = str(uuid.uuid4())
 
-        self.config = config.initialize(
-            self.package_dir,
-            self.package_name,
-            reporter_token=self.reporter_token,
+class InfestorTestCase(unittest.TestCase):
+    script_basename = "a_script.py"
+    package_name = "a_package"
+    # Set up by setUpClass.
+    template_repository: str
+    temporary_directory_root: Optional[str]
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Initializing a git repository, copying the fixtures into it and committing them
+        is the same for every test in a class. So it is only done once, into a template
+        repository. Each test works on its own copy of the template.
+        """
+        cls.temporary_directory_root = temporary_directory_root()
+        cls.template_repository = tempfile.mkdtemp(
+            prefix=f"infestor-{os.getpid()}-", dir=cls.temporary_directory_root
         )
+        repo = pygit2.init_repository(cls.template_repository, False)
 
-        self.config_file = config.default_config_file(self.package_dir)
+        cls.fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+
+        script_file_fixture = os.path.join(cls.fixtures_dir, cls.script_basename)
+        shutil.copyfile(
+            script_file_fixture,
+            os.path.join(cls.template_repository, cls.script_basename),
+        )
+
+        package_dir_fixture = os.path.join(cls.fixtures_dir, cls.package_name)
+        package_dir = os.path.join(cls.template_repository, cls.package_name)
+        shutil.copytree(package_dir_fixture, package_dir)
+
+        cls.reporter_token = str(uuid.uuid4())
+
+        config.initialize(
+            package_dir,
+            cls.package_name,
+            reporter_token=cls.reporter_token,
+        )
 
         package_files = [
-            os.path.relpath(python_file, start=self.repository)
-            for python_file in glob.glob(os.path.join(self.package_dir, "*.py"))
+            os.path.join(cls.package_name, entry.name)
+            for entry in os.scandir(package_dir)
+            if entry.name.endswith(".py") and entry.is_file()
         ]
         commit.commit_files(
-            self.repository,
+            repo,
             "refs/heads/master",
             [
-                script_basename,
+                cls.script_basename,
                 *package_files,
-                os.path.join(package_basename, config.CONFIG_FILENAME),
+                os.path.join(cls.package_name, config.CONFIG_FILENAME),
             ],
             "initial commit",
         )
 
+    @classmethod
+    def tearDownClass(cls) -> None:
+        remove_directory(cls.template_repository, cls.temporary_directory_root)
+
+    @classmethod
+    def copy_template_file(cls, source: str, destination: str) -> str:
+        """
+        Git never modifies its object files once they are written, so copies of the
+        template repository hard link them instead of copying them. Every other file is
+        copied, since tests rewrite package files in place and a hard link would carry
+        those changes back into the template.
+        """
+        relative_path = os.path.relpath(source, start=cls.template_repository)
+        if relative_path.startswith(os.path.join(".git", "objects", "")):
+            try:
+                os.link(source, destination)
+                return destination
+            except OSError:
+                pass
+        return shutil.copy2(source, destination)
+
+    def setUp(self):
+        self.repository = tempfile.mkdtemp(
+            prefix=f"infestor-{os.getpid()}-", dir=self.temporary_directory_root
+        )
+        shutil.copytree(
+            self.template_repository,
+            self.repository,
+            copy_function=self.copy_template_file,
+            dirs_exist_ok=True,
+        )
+
+        self.script_file = os.path.join(self.repository, self.script_basename)
+        self.package_dir = os.path.join(self.repository, self.package_name)
+        self.config_file = config.default_config_file(self.package_dir)
+        self.config = config.load_config(self.config_file)
+
     def tearDown(self) -> None:
         DEBUG = os.getenv("DEBUG")
         if DEBUG != "1":
-            shutil.rmtree(self.repository)
+            remove_directory(self.repository, self.temporary_directory_root)
         else:
             print(
                 f"DEBUG=1: Retaining test directory - {self.repository}",
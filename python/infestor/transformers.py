@@ -1,17 +1,15 @@
-from typing import Optional, List, Union, cast
+from typing import FrozenSet, Iterable, Optional, List, Union, cast
 
 import libcst as cst
 import libcst.matchers as m
 
 
+IMPORT_STATEMENT_TYPES = frozenset([cst.Import, cst.ImportFrom])
+
+
 def matches_import(node: cst.CSTNode) -> bool:
-    return m.matches(
-        node,
-        m.SimpleStatementLine(
-            body=m.MatchIfTrue(
-                lambda body: all(m.matches(el, m.Import | m.ImportFrom) for el in body)
-            )
-        ),
+    return isinstance(node, cst.SimpleStatementLine) and all(
+        type(el) in IMPORT_STATEMENT_TYPES for el in node.body
     )
 
 
@@ -113,6 +111,7 @@ class ReporterCallsRemoverTransformer(cst.CSTTransformer):
 
         self.reporter_imported_as = reporter_imported_as
         self.call_type = call_type
+        self.calls_removed = 0
 
     def leave_Module(
         self, original_node: cst.Module, updated_node: cst.Module
@@ -122,6 +121,8 @@ class ReporterCallsRemoverTransformer(cst.CSTTransformer):
         for el in original_node.body:
             if not self.matches_reporter_call(el):
                 new_body.append(el)
+            else:
+                self.calls_removed += 1
 
         return updated_node.with_changes(body=new_body)
 
@@ -132,9 +133,9 @@ ERROR_REPORT_CALL = "error_report"
 class TryExceptAdderTransformer(cst.CSTTransformer):
     METADATA_DEPENDENCIES = (cst.metadata.PositionProvider,)
 
-    def __init__(self, reported_imported_as: str, linenos: List[int]):
+    def __init__(self, reported_imported_as: str, linenos: Iterable[int]):
         self.reporter_imported_as = reported_imported_as
-        self.linenos = linenos
+        self.linenos: FrozenSet[int] = frozenset(linenos)
         self.func_scope: List[int] = []
 
     def has_except_asname(self, node: cst.ExceptHandler):
@@ -243,9 +244,9 @@ class TryExceptAdderTransformer(cst.CSTTransformer):
 class TryExceptRemoverTransformer(cst.CSTTransformer):
     METADATA_DEPENDENCIES = (cst.metadata.PositionProvider,)
 
-    def __init__(self, reported_imported_as: str, linenos: List[int]):
+    def __init__(self, reported_imported_as: str, linenos: Iterable[int]):
         self.reporter_imported_as = reported_imported_as
-        self.linenos = linenos
+        self.linenos: FrozenSet[int] = frozenset(linenos)
         self.func_scope: List[int] = []
 
     def has_except_asname(self, node: cst.ExceptHandler):
@@ -343,60 +344,88 @@ class TryExceptRemoverTransformer(cst.CSTTransformer):
 def matches_with_reporter_decorator(
     node: cst.Decorator, reporter_imported_as, decorator_type
 ):
-    return m.matches(
-        node,
-        m.Decorator(
-            decorator=m.Attribute(
-                value=m.Name(value=reporter_imported_as),
-                attr=m.Name(value=decorator_type),
-            )
-        ),
+    # Checked directly rather than with libcst.matchers - this runs for every decorator
+    # on every function definition in a file.
+    decorator = node.decorator
+    return (
+        isinstance(decorator, cst.Attribute)
+        and decorator.attr.value == decorator_type
+        and isinstance(decorator.value, cst.Name)
+        and decorator.value.value == reporter_imported_as
+    )
+
+
+def add_reporter_decorator(
+    node: cst.FunctionDef, reporter_imported_as: str, decorator_type: str
+) -> cst.FunctionDef:
+    """
+    Adds the given reporter decorator to the given function definition, unless the
+    function is already decorated with it.
+    """
+    for decorator in node.decorators:
+        if matches_with_reporter_decorator(
+            decorator, reporter_imported_as, decorator_type
+        ):
+            return node
+
+    decorator_to_add = cst.Decorator(
+        decorator=cst.Attribute(
+            value=cst.Name(
+                value=reporter_imported_as,
+            ),
+            attr=cst.Name(
+                value=decorator_type,
+            ),
+        )
     )
+    return node.with_changes(decorators=[decorator_to_add, *node.decorators])
+
+
+def remove_reporter_decorator(
+    node: cst.FunctionDef, reporter_imported_as: str, decorator_type: str
+) -> cst.FunctionDef:
+    """
+    Removes the given reporter decorator from the given function definition.
+    """
+    decorators = []
+    for decorator in node.decorators:
+        if not matches_with_reporter_decorator(
+            decorator, reporter_imported_as, decorator_type
+        ):
+            decorators.append(decorator)
+
+    return node.with_changes(decorators=decorators)
 
 
 class DecoratorsAdderTransformer(cst.CSTTransformer):
     METADATA_DEPENDENCIES = (cst.metadata.PositionProvider,)
 
-    def __init__(self, reporter_imported_as, decorator_type, lines_to_add: List[int]):
+    def __init__(
+        self, reporter_imported_as, decorator_type, lines_to_add: Iterable[int]
+    ):
         self.reporter_imported_as = reporter_imported_as
-        self.lines_to_add = lines_to_add
+        self.lines_to_add: FrozenSet[int] = frozenset(lines_to_add)
         self.decorator_type = decorator_type
-        self.decorator_to_add = cst.Decorator(
-            decorator=cst.Attribute(
-                value=cst.Name(
-                    value=reporter_imported_as,
-                ),
-                attr=cst.Name(
-                    value=decorator_type,
-                ),
-            )
-        )
 
     def leave_FunctionDef(self, original_node, updated_node):
         position = self.get_metadata(cst.metadata.PositionProvider, original_node)
         if position.start.line not in self.lines_to_add:
             return updated_node
 
-        decorators = [self.decorator_to_add]
-        for decorator in updated_node.decorators:
-            decorators.append(decorator)
-            if matches_with_reporter_decorator(
-                decorator, self.reporter_imported_as, self.decorator_type
-            ):
-                return updated_node
-
-        return updated_node.with_changes(decorators=decorators)
+        return add_reporter_decorator(
+            updated_node, self.reporter_imported_as, self.decorator_type
+        )
 
 
 class DecoratorsRemoverTransformer(cst.CSTTransformer):
     METADATA_DEPENDENCIES = (cst.metadata.PositionProvider,)
 
     def __init__(
-        self, reporter_imported_as, decorator_type, lines_to_remove: List[int]
+        self, reporter_imported_as, decorator_type, lines_to_remove: Iterable[int]
     ):
         self.reporter_imported_as = reporter_imported_as
         self.decorator_type = decorator_type
-        self.lines_to_remove = lines_to_remove
+        self.lines_to_remove: FrozenSet[int] = frozenset(lines_to_remove)
 
     def leave_FunctionDef(self, original_node, updated_node):
         position = self.get_metadata(cst.metadata.PositionProvider, original_node)
@@ -404,11 +433,65 @@ class DecoratorsRemoverTransformer(cst.CSTTransformer):
         if position.start.line not in self.lines_to_remove:
             return updated_node
 
-        decorators = []
-        for decorator in updated_node.decorators:
-            if not matches_with_reporter_decorator(
-                decorator, self.reporter_imported_as, self.decorator_type
-            ):
-                decorators.append(decorator)
+        return remove_reporter_decorator(
+            updated_node, self.reporter_imported_as, self.decorator_type
+        )
+
+
+class RecordErrorsAdderTransformer(TryExceptAdderTransformer):
+    """
+    Decorates the functions defined at the given linenos with the given reporter
+    decorator and reports the errors caught in their except handlers, in a single pass
+    over the module.
+
+    Since both changes are made in one pass, the linenos always refer to the module
+    before any changes were made.
+    """
+
+    def __init__(
+        self, reporter_imported_as: str, decorator_type: str, linenos: Iterable[int]
+    ):
+        super().__init__(reporter_imported_as, linenos)
+        self.decorator_type = decorator_type
+
+    def leave_FunctionDef(
+        self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef
+    ) -> Union[
+        cst.BaseStatement, cst.FlattenSentinel[cst.BaseStatement], cst.RemovalSentinel
+    ]:
+        lineno = self.func_scope[-1]
+        super().leave_FunctionDef(original_node, updated_node)
+        if lineno not in self.linenos:
+            return updated_node
+
+        return add_reporter_decorator(
+            updated_node, self.reporter_imported_as, self.decorator_type
+        )
 
-        return updated_node.with_changes(decorators=decorators)
+
+class RecordErrorsRemoverTransformer(TryExceptRemoverTransformer):
+    """
+    Removes the given reporter decorator from the functions defined at the given linenos
+    and stops reporting the errors caught in their except handlers, in a single pass
+    over the module.
+    """
+
+    def __init__(
+        self, reporter_imported_as: str, decorator_type: str, linenos: Iterable[int]
+    ):
+        super().__init__(reporter_imported_as, linenos)
+        self.decorator_type = decorator_type
+
+    def leave_FunctionDef(
+        self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef
+    ) -> Union[
+        cst.BaseStatement, cst.FlattenSentinel[cst.BaseStatement], cst.RemovalSentinel
+    ]:
+        lineno = self.func_scope[-1]
+        super().leave_FunctionDef(original_node, updated_node)
+        if lineno not in self.linenos:
+            return updated_node
+
+        return remove_reporter_decorator(
+            updated_node, self.reporter_imported_as, self.decorator_type
+        )
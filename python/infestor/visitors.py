@@ -1,19 +1,110 @@
-from typing import Optional, List, Tuple, Dict, cast
+from collections import defaultdict
+from typing import (
+    Callable,
+    ClassVar,
+    Dict,
+    Optional,
+    List,
+    Set,
+    Tuple,
+    Type,
+    DefaultDict,
+    cast,
+)
 
-import libcst.matchers as m
 import libcst as cst
 import logging
+import sys
 from . import models
 from . import manager
-from . import transformers
+
+
+# Names which reporter modules import from the humbug library.
+HUMBUG_MODULE = "humbug"
+HUMBUG_CONSENT_SUBMODULE = "consent"
+HUMBUG_REPORT_SUBMODULE = "report"
+HUMBUG_SUBMODULES = frozenset([HUMBUG_CONSENT_SUBMODULE, HUMBUG_REPORT_SUBMODULE])
+HUMBUG_CONSENT = "HumbugConsent"
+HUMBUG_REPORTER = "HumbugReporter"
 
 
 class ReporterNotImported(Exception):
     pass
 
 
-class ReporterFileVisitor(cst.CSTVisitor):
-    METADATA_DEPENDENCIES = (cst.metadata.PositionProvider,)
+def skip_subtree(visitor: cst.CSTVisitor, node: cst.CSTNode) -> Optional[bool]:
+    return False
+
+
+class DispatchTableVisitor(cst.CSTVisitor):
+    """
+    libcst looks visit_<node type> and leave_<node type> methods up by name for every
+    node it visits. Subclasses of this visitor map node types straight to those methods
+    instead, through tables which are built once, when the subclass is defined. Subtrees
+    under the node types in PRUNED_NODE_TYPES are not visited at all, unless the
+    subclass defines a visit method for them.
+
+    Attribute visitors (visit_<node type>_<attribute>) are not supported. The lookups
+    for them are skipped entirely.
+    """
+
+    PRUNED_NODE_TYPES: ClassVar[Tuple[Type[cst.CSTNode], ...]] = ()
+    VISIT_DISPATCH: ClassVar[
+        Dict[Type[cst.CSTNode], Callable[..., Optional[bool]]]
+    ] = {}
+    LEAVE_DISPATCH: ClassVar[Dict[Type[cst.CSTNode], Callable[..., None]]] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        visit_dispatch: Dict[Type[cst.CSTNode], Callable[..., Optional[bool]]] = {
+            node_type: skip_subtree for node_type in cls.PRUNED_NODE_TYPES
+        }
+        leave_dispatch: Dict[Type[cst.CSTNode], Callable[..., None]] = {}
+        for name in dir(cls):
+            if name.startswith("visit_"):
+                dispatch: Dict[Type[cst.CSTNode], Callable] = visit_dispatch
+                node_type_name = name[len("visit_") :]
+            elif name.startswith("leave_"):
+                dispatch = leave_dispatch
+                node_type_name = name[len("leave_") :]
+            else:
+                continue
+            method = getattr(cls, name)
+            # libcst's base visitor defines a (no-op) method for every node type. Only
+            # the methods which the subclasses override need to be dispatched to.
+            if method is getattr(cst.CSTVisitor, name, None):
+                continue
+            node_type = getattr(cst, node_type_name, None)
+            if isinstance(node_type, type) and issubclass(node_type, cst.CSTNode):
+                dispatch[node_type] = method
+        cls.VISIT_DISPATCH = visit_dispatch
+        cls.LEAVE_DISPATCH = leave_dispatch
+
+    def on_visit(self, node: cst.CSTNode) -> bool:
+        visit = self.VISIT_DISPATCH.get(type(node))
+        return visit is None or visit(self, node) is not False
+
+    def on_leave(self, original_node: cst.CSTNode) -> None:
+        leave = self.LEAVE_DISPATCH.get(type(original_node))
+        if leave is not None:
+            leave(self, original_node)
+
+    def on_visit_attribute(self, node: cst.CSTNode, attribute: str) -> None:
+        pass
+
+    def on_leave_attribute(self, original_node: cst.CSTNode, attribute: str) -> None:
+        pass
+
+
+class ReporterFileVisitor(DispatchTableVisitor):
+    """
+    Inspects a reporter module.
+
+    The *At attributes do not hold line numbers. They hold the position of the node in
+    the order in which the visitor reached it, which increases along the source. That
+    is enough to check the order of the imports and instantiations, and it spares the
+    visitor the metadata wrapper (and the copy of the syntax tree that comes with it).
+    """
 
     def __init__(self):
         self.HumbugConsentImportedAs: str = ""
@@ -26,49 +117,71 @@ class ReporterFileVisitor(cst.CSTVisitor):
         self.HumbugReporterInstantiatedAt: int = -1
         self.HumbugReporterConsentArgument: str = ""
         self.HumbugReporterTokenArgument: str = ""
+        self.visit_order: int = 0
 
     @staticmethod
-    def syntax_tree(reporter_filepath: str) -> cst.MetadataWrapper:
-        with open(reporter_filepath, "r") as ifp:
+    def syntax_tree(reporter_filepath: str) -> cst.Module:
+        # libcst detects the encoding of the source itself when it is given bytes.
+        with open(reporter_filepath, "rb") as ifp:
             reporter_file_source = ifp.read()
-        reporter_syntax_tree = cst.metadata.MetadataWrapper(
-            cst.parse_module(reporter_file_source)
+        return cst.parse_module(reporter_file_source)
+
+    def done(self) -> bool:
+        """
+        Returns True once the visitor has found everything it looks for.
+        """
+        return (
+            self.HumbugConsentInstantiatedAt != -1
+            and self.HumbugReporterInstantiatedAt != -1
+            and self.HumbugReporterConsentArgument != ""
+            and self.HumbugReporterTokenArgument != ""
         )
-        return reporter_syntax_tree
+
+    def on_visit(self, node: cst.CSTNode) -> bool:
+        # There is nothing left to find, so the rest of the module need not be visited.
+        if self.done():
+            return False
+        self.visit_order += 1
+        return super().on_visit(node)
+
+    # The reporter is imported and instantiated at module level, so function and class
+    # bodies need not be visited.
+    def visit_FunctionDef(self, node: cst.FunctionDef) -> Optional[bool]:
+        return False
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> Optional[bool]:
+        return False
 
     def visit_ImportFrom(self, node: cst.ImportFrom) -> Optional[bool]:
-        position = self.get_metadata(cst.metadata.PositionProvider, node)  # type: ignore
         if (
             isinstance(node.module, cst.Attribute)
             and isinstance(node.module.value, cst.Name)
-            and node.module.value.value == "humbug"
+            and node.module.value.value == HUMBUG_MODULE
+            and node.module.attr.value in HUMBUG_SUBMODULES
+            and not isinstance(node.names, cst.ImportStar)
         ):
-            if node.module.attr.value == "consent" and not isinstance(
-                node.names, cst.ImportStar
-            ):
+            if node.module.attr.value == HUMBUG_CONSENT_SUBMODULE:
                 for name in node.names:
-                    if name.name.value == "HumbugConsent":
-                        self.HumbugConsentImportedAs = "HumbugConsent"
+                    if name.name.value == HUMBUG_CONSENT:
+                        self.HumbugConsentImportedAs = HUMBUG_CONSENT
 
                         if name.asname is not None and isinstance(
                             name.asname, cst.Name
                         ):
                             self.HumbugConsentImportedAs = name.asname.value
 
-                        self.HumbugConsentImportedAt = position.start.line
-            elif node.module.attr.value == "report" and not isinstance(
-                node.names, cst.ImportStar
-            ):
+                        self.HumbugConsentImportedAt = self.visit_order
+            else:
                 for name in node.names:
-                    if name.name.value == "HumbugReporter":
-                        self.HumbugReporterImportedAs = "HumbugReporter"
+                    if name.name.value == HUMBUG_REPORTER:
+                        self.HumbugReporterImportedAs = HUMBUG_REPORTER
 
                         if name.asname is not None and isinstance(
                             name.asname, cst.Name
                         ):
                             self.HumbugReporterImportedAs = name.asname.value
 
-                        self.HumbugReporterImportedAt = position.start.line
+                        self.HumbugReporterImportedAt = self.visit_order
 
         return False
 
@@ -80,13 +193,11 @@ class ReporterFileVisitor(cst.CSTVisitor):
             and isinstance(node.targets[0].target, cst.Name)
         ):
             if node.value.func.value == self.HumbugConsentImportedAs:
-                position = self.get_metadata(cst.metadata.PositionProvider, node)  # type: ignore
-                self.HumbugConsentInstantiatedAt = position.start.line
+                self.HumbugConsentInstantiatedAt = self.visit_order
                 self.HumbugConsentInstantiatedAs = node.targets[0].target.value
                 return False
             elif node.value.func.value == self.HumbugReporterImportedAs:
-                position = self.get_metadata(cst.metadata.PositionProvider, node)  # type: ignore
-                self.HumbugReporterInstantiatedAt = position.start.line
+                self.HumbugReporterInstantiatedAt = self.visit_order
                 self.HumbugReporterInstantiatedAs = node.targets[0].target.value
         return True
 
@@ -111,45 +222,24 @@ class ReporterFileVisitor(cst.CSTVisitor):
         return False
 
 
-class DecoratorCandidatesVisitor(cst.CSTVisitor):
-    METADATA_DEPENDENCIES = (cst.metadata.PositionProvider,)
-
-    def __init__(self, reporter_imported_as, decorator_type):
-        self.reporter_imported_as = reporter_imported_as
-        self.decorator_type = decorator_type
-        self.scope_stack: List[str] = []
-        self.decorator_candidates: List[models.ReporterDecoratorCandidate] = []
-
-    def visit_FunctionDef(self, node: cst.FunctionDef) -> Optional[bool]:
-        self.scope_stack.append(node.name.value)
-
-        for decorator in node.decorators:
-            if transformers.matches_with_reporter_decorator(
-                decorator, self.reporter_imported_as, self.decorator_type
-            ):
-                return True
-
-        position = self.get_metadata(cst.metadata.PositionProvider, node)
-        self.decorator_candidates.append(
-            models.ReporterDecoratorCandidate(
-                scope_stack=".".join(self.scope_stack), lineno=position.start.line
-            )
-        )
-        return True
-
-    def leave_FunctionDef(self, original_node: cst.FunctionDef) -> None:
-        self.scope_stack.pop()
-
-    def visit_ClassDef(self, node: cst.ClassDef) -> Optional[bool]:
-        self.scope_stack.append(node.name.value)
-        return True
-
-    def leave_ClassDef(self, original_node: cst.ClassDef) -> None:
-        self.scope_stack.pop()
-
-
-class PackageFileVisitor(cst.CSTVisitor):
+class PackageFileVisitor(DispatchTableVisitor):
     METADATA_DEPENDENCIES = (cst.metadata.PositionProvider,)
+    # Reporter calls and decorators cannot occur under these nodes (or, in the case of
+    # annotations, are of no interest there), so their subtrees are not visited. Most
+    # of them are leaves which only hold whitespace and parentheses.
+    PRUNED_NODE_TYPES = (
+        cst.Annotation,
+        cst.Comma,
+        cst.Comment,
+        cst.Dot,
+        cst.EmptyLine,
+        cst.Float,
+        cst.Imaginary,
+        cst.Integer,
+        cst.Name,
+        cst.SimpleString,
+        cst.TrailingWhitespace,
+    )
     last_import_lineno = 0
 
     def __init__(
@@ -164,82 +254,133 @@ class PackageFileVisitor(cst.CSTVisitor):
 
         self.relative_imports = relative_imports
         self.reporter_module_path = reporter_module_path
+        # TODO: Refactor this
+        # The reporter module path basename, against which package imports are checked.
+        self.reporter_package_name = reporter_module_path.rsplit(".", 1)[0]
         self.scope_stack: List[str] = []
+        # Dotted scope path at each depth of scope_stack, shared by every model created
+        # in that scope.
+        self.scope_paths: List[str] = []
         self.reporter_object_name = reporter_object_name
         self.seeking_import_node = cst.parse_statement(
             f"from {reporter_module_path} import {reporter_object_name}"
         )
 
-        self.calls: Dict[str, List[models.ReporterCall]] = {}
-        self.decorators: Dict[str, List[models.ReporterDecorator]] = {}
+        self.calls: DefaultDict[str, List[models.ReporterCall]] = defaultdict(list)
+        self.decorators: DefaultDict[
+            str, List[models.ReporterDecorator]
+        ] = defaultdict(list)
+        # Scope stack, lineno and (decorator name, decorator attribute) pairs of every
+        # function definition, from which decorator candidates are computed.
+        self.function_definitions: List[Tuple[str, int, Set[Tuple[str, str]]]] = []
 
     # TODO(yhtiyar) also add checking with 'import'
-    def matches_with_package_import(self, node: cst.ImportFrom):
-        return m.matches(
-            node,
-            m.ImportFrom(
-                module=m.Attribute(
-                    value=m.Name(
-                        # TODO: Refactor this
-                        value=self.reporter_module_path.rsplit(".", 1)[
-                            0
-                        ]  # checking for reporter module path basename
-                    ),
-                    attr=m.Name(value="report"),
-                ),
-            ),
+    def matches_with_package_import(self, node: cst.ImportFrom) -> bool:
+        module = node.module
+        return (
+            isinstance(module, cst.Attribute)
+            and isinstance(module.value, cst.Name)
+            and module.value.value == self.reporter_package_name
+            and module.attr.value == "report"
         )
 
-    def matches_reporter_call(self, node: cst.Call):
-        return m.matches(
-            node,
-            m.Call(
-                func=m.Attribute(
-                    value=m.Name(value=self.ReporterImportedAs),
-                ),
-            ),
+    # These checks are written out rather than expressed with libcst matchers, since
+    # they run on every call and decorator in a module and matchers are much slower.
+    def matches_reporter_call(self, node: cst.Call) -> bool:
+        func = node.func
+        return (
+            isinstance(func, cst.Attribute)
+            and isinstance(func.value, cst.Name)
+            and func.value.value == self.ReporterImportedAs
         )
 
-    def matches_with_reporter_decorator(self, node: cst.Decorator):
-        return m.matches(
-            node,
-            m.Decorator(
-                decorator=m.Attribute(
-                    value=m.Name(value=self.ReporterImportedAs),
-                )
-            ),
+    def matches_with_reporter_decorator(self, node: cst.Decorator) -> bool:
+        decorator = node.decorator
+        return (
+            isinstance(decorator, cst.Attribute)
+            and isinstance(decorator.value, cst.Name)
+            and decorator.value.value == self.ReporterImportedAs
         )
 
+    def position(self, node: cst.CSTNode) -> cst.metadata.CodeRange:
+        """
+        Same as get_metadata(PositionProvider, node), but reads the positions which the
+        metadata wrapper resolved before the visit directly. This skips the dependency
+        checks get_metadata makes on every call.
+        """
+        position = self.metadata[cst.metadata.PositionProvider][node]
+        if isinstance(position, cst.metadata.CodeRange):
+            return position
+        # Metadata values may be computed lazily.
+        return cast(Callable[[], cst.metadata.CodeRange], position)()
+
+    def enter_scope(self, name: str) -> None:
+        name = sys.intern(name)
+        self.scope_stack.append(name)
+        if self.scope_paths:
+            self.scope_paths.append(sys.intern(f"{self.scope_paths[-1]}.{name}"))
+        else:
+            self.scope_paths.append(name)
+
+    def leave_scope(self) -> None:
+        self.scope_stack.pop()
+        self.scope_paths.pop()
+
+    def current_scope_path(self) -> str:
+        return self.scope_paths[-1] if self.scope_paths else ""
+
     def visit_FunctionDef(self, node: cst.FunctionDef):
-        self.scope_stack.append(node.name.value)
+        self.enter_scope(node.name.value)
+        position = self.position(node)
+        scope_stack = self.scope_paths[-1]
+        attribute_decorators: Set[Tuple[str, str]] = set()
         for decorator in node.decorators:
+            if isinstance(decorator.decorator, cst.Attribute) and isinstance(
+                decorator.decorator.value, cst.Name
+            ):
+                attribute_decorators.add(
+                    (decorator.decorator.value.value, decorator.decorator.attr.value)
+                )
             if self.matches_with_reporter_decorator(decorator):
-                position = self.get_metadata(cst.metadata.PositionProvider, node)
                 decorator_attribute = cast(cst.Attribute, decorator.decorator)
                 decorator_model = models.ReporterDecorator(
                     decorator_type=decorator_attribute.attr.value,
-                    scope_stack=".".join(self.scope_stack),
+                    scope_stack=scope_stack,
                     lineno=position.start.line,
                 )
-                self.decorators.setdefault(decorator_model.decorator_type, []).append(
-                    decorator_model
-                )
+                self.decorators[decorator_model.decorator_type].append(decorator_model)
+        self.function_definitions.append(
+            (scope_stack, position.start.line, attribute_decorators)
+        )
         return True
 
+    def decorator_candidates(
+        self, decorator_type: str
+    ) -> List[models.ReporterDecoratorCandidate]:
+        """
+        Returns the functions which are not decorated with the given reporter decorator.
+        """
+        reporter_decorator = (self.ReporterImportedAs, decorator_type)
+        return [
+            models.ReporterDecoratorCandidate(scope_stack=scope_stack, lineno=lineno)
+            for scope_stack, lineno, decorators in self.function_definitions
+            if reporter_decorator not in decorators
+        ]
+
     def leave_FunctionDef(self, original_node: cst.FunctionDef) -> None:
-        self.scope_stack.pop()
+        self.leave_scope()
 
     def visit_ClassDef(self, node: cst.ClassDef):
-        self.scope_stack.append(node.name.value)
+        self.enter_scope(node.name.value)
         return True
 
     def leave_ClassDef(self, original_node: cst.ClassDef) -> None:
-        self.scope_stack.pop()
+        self.leave_scope()
 
     def visit_Import(self, node: cst.Import) -> Optional[bool]:
         if self.scope_stack:
             return False
-        position = self.get_metadata(cst.metadata.PositionProvider, node)
+        position = self.position(node)
         self.last_import_lineno = position.end.line
         return False
 
@@ -260,15 +401,24 @@ class PackageFileVisitor(cst.CSTVisitor):
     def visit_ImportFrom(self, node: cst.ImportFrom) -> Optional[bool]:
         if self.scope_stack:
             return False
-        position = self.get_metadata(cst.metadata.PositionProvider, node)
-
-        temp_node = cst.SimpleStatementLine(body=[node])
-        if temp_node.deep_equals(self.seeking_import_node):
-            self.ReporterImportedAs = self.reporter_object_name
-            self.ReporterImportedAt = position.start.line
-            self.ReporterCorrectlyImported = (
-                position.start.line == self.last_import_lineno + 1
-            )
+        position = self.position(node)
+
+        # The reporter import names a single object, the reporter. Checking that first
+        # spares most imports the comparison against the whole reporter import.
+        names = node.names
+        if (
+            not isinstance(names, cst.ImportStar)
+            and len(names) == 1
+            and isinstance(names[0].name, cst.Name)
+            and names[0].name.value == self.reporter_object_name
+        ):
+            temp_node = cst.SimpleStatementLine(body=[node])
+            if temp_node.deep_equals(self.seeking_import_node):
+                self.ReporterImportedAs = self.reporter_object_name
+                self.ReporterImportedAt = position.start.line
+                self.ReporterCorrectlyImported = (
+                    position.start.line == self.last_import_lineno + 1
+                )
 
         self.last_import_lineno = position.end.line
         return False
@@ -277,12 +427,12 @@ class PackageFileVisitor(cst.CSTVisitor):
         if self.ReporterImportedAt == -1:
             return False
         if self.matches_reporter_call(node):
-            position = self.get_metadata(cst.metadata.PositionProvider, node)
+            position = self.position(node)
             func_attr = cast(cst.Attribute, node.func)
             call_model = models.ReporterCall(
                 call_type=func_attr.attr.value,
                 lineno=position.start.line,
-                scope_stack=".".join(self.scope_stack),
+                scope_stack=self.current_scope_path(),
             )
-            self.calls.setdefault(call_model.call_type, []).append(call_model)
+            self.calls[call_model.call_type].append(call_model)
         return False
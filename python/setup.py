@@ -13,7 +13,7 @@ setup(
     version=INFESTOR_VERSION,
     packages=find_packages(),
     python_requires=">=3.8",
-    install_requires=["atomicwrites", "humbug", "libcst", "pygit2", "pydantic"],
+    install_requires=["atomicwrites", "humbug", "libcst", "pygit2"],
     extras_require={
         "dev": ["black", "mypy", "wheel", "types-atomicwrites"],
         "distribute": ["setuptools", "twine", "wheel"],